@@ -4,33 +4,47 @@ finding problem defined in the map.
  
 The evolutionary algorithm uses the linear distance to the goal as a fitness
 function and uses crossover and mutation to evolve the population.
+
+As an alternative optimizer, a covariance matrix adaptation evolution strategy
+(CMA-ES) searches over a compressed representation of the move sequence, using
+the same fitness function.
 """
 
 from random import random, randint, gauss, seed, choices
 from math import inf
 from numpy import polyfit, poly1d
+import numpy as np
 from multiprocessing import Pool
+from queue import Queue, Empty, Full
+import threading
 
 from bubbles import *
 from map import *
 
-class EvolutionaryAlgorithm():
-    def __init__(self, map, generations, population_size, mutation_rate, mutation_strength):
+class Optimizer():
+    # base class of all optimizers, subclasses implement run_generation
+
+    def __init__(self, map, generations, population_size):
         self.map = map
-        
+
         self.generations = generations
         self.population_size = population_size
-        self.mutation_rate = mutation_rate
-        self.mutation_strength = mutation_strength
 
         self.population = []
         self.solution_length = 200
-        
-        self.initialize_population()
+        self.evaluations = 0
 
-    def initialize_population(self):
-        self.population = [Bubble(move_sequence_length=self.solution_length) 
-                           for _ in range(self.population_size)]    
+        self.last_generation = [] # (x, y, radius, color) of the last simulated bubbles
+        self.stopped = False
+
+        self.map_batch = None
+        self.aggregation = "mean"
+
+    def evaluate_on_maps(self, maps, aggregation="mean"):
+        # evaluate every bubble on all maps instead of self.map, the fitness of
+        # the maps is aggregated with "mean", "worst" or "success_rate"
+        self.map_batch = MapBatch(maps)
+        self.aggregation = aggregation
 
     def run(self, status_callback=None, visualize=True):
         for i in range(1, self.generations + 1): 
@@ -43,29 +57,23 @@ class EvolutionaryAlgorithm():
                 status_callback(status)
             print(status)
         
-            if success:
+            if success or self.stopped:
                 break
 
         return i
 
     def run_generation(self, visualize):
-        
-        self.map.simulate(self.population, visualize=visualize)
-        self.evaluate_population()
-        
-        self.population = sorted(self.population, key=lambda bubble: bubble.fitness, reverse=True)
-        
-        best = self.population[0].fitness
-        avg = sum([bubble.fitness for bubble in self.population]) / len(self.population)
-        success = any([bubble.won for bubble in self.population])
+        raise NotImplementedError()
 
-        survivors = self.natural_selection()
-        offspring = self.breed(survivors, self.population_size - len(survivors))
-        self.mutate(survivors)
-        
-        self.population = survivors + offspring
+    def simulate_population(self, visualize):
+        if self.map_batch is not None:
+            self.simulate_population_on_maps()
+        else:
+            self.map.simulate(self.population, visualize=visualize)
+            self.evaluate_population()
+            self.evaluations += len(self.population)
 
-        return best, avg, success     
+        self.last_generation = [(bubble.x, bubble.y, bubble.radius, bubble.color) for bubble in self.population]
 
     def evaluate_population(self):
         
@@ -82,6 +90,116 @@ class EvolutionaryAlgorithm():
         distance = max(0, self.map.goal.distance_to(bubble.x, bubble.y) - bubble.radius - self.map.goal.radius)
         return distance
 
+    def simulate_population_on_maps(self):
+        distances, won, positions = self.map_batch.simulate(self.population)
+        self.evaluations += len(self.population) * len(self.map_batch)
+
+        # same linear mapping from distance to fitness as evaluate_population
+        fitness = 1 - distances / self.map_batch.distance_start_to_goal
+
+        if self.aggregation == "worst":
+            aggregated_fitness = np.min(fitness, axis=1)
+        elif self.aggregation == "success_rate":
+            # the mean fitness breaks ties, so there is a gradient before any goal is reached
+            aggregated_fitness = np.mean(won, axis=1) + 0.01 * np.mean(fitness, axis=1)
+        else:
+            aggregated_fitness = np.mean(fitness, axis=1)
+
+        # a bubble only succeeds if it reaches the goal of every map, its
+        # position is the one on the first map
+        for bubble, bubble_fitness, bubble_won, position in zip(self.population, aggregated_fitness, np.all(won, axis=1), positions[:, 0]):
+            bubble.fitness = bubble_fitness
+            bubble.won = bool(bubble_won)
+            bubble.disabled = True
+            bubble.x, bubble.y = position
+            bubble.color = "green" if bubble.won else "red"
+
+
+class EvolutionaryAlgorithm(Optimizer):
+    def __init__(self, map, generations, population_size, mutation_rate, mutation_strength, seed_fraction=0, seed_noise=0.2):
+        super().__init__(map, generations, population_size)
+
+        self.mutation_rate = mutation_rate
+        self.mutation_strength = mutation_strength
+
+        # fraction of the initial population that follows the approx path
+        self.seed_fraction = seed_fraction
+        self.seed_noise = seed_noise
+        
+        self.initialize_population()
+
+    def initialize_population(self):
+        self.population = [Bubble(move_sequence_length=self.solution_length) 
+                           for _ in range(self.population_size)]    
+
+        n_seeded = int(self.population_size * self.seed_fraction)
+        if n_seeded == 0:
+            return
+
+        path_move_sequence = self.path_to_move_sequence(self.population[0].step_size, self.population[0].radius)
+        for bubble in self.population[:n_seeded]:
+            bubble.move_sequence = [
+                (dx + gauss(0, self.seed_noise), dy + gauss(0, self.seed_noise))
+                for dx, dy in path_move_sequence
+            ] + bubble.move_sequence[len(path_move_sequence):]
+
+    def path_to_move_sequence(self, step_size, radius):
+        # keep a distance of the bubble radius to the obstacles, the path only
+        # has a distance of 1 to the corners
+        compiled_map = CompiledMap(self.map, radius=radius + 1)
+        width, height, margin = self.map.width, self.map.height, radius + 1
+        # the border is an obstacle as well, gaps between an obstacle and the
+        # border that are too small for a bubble must not be used
+        border = [
+            Box(-width, -height, 3 * width, height + margin),
+            Box(-width, height - margin, 3 * width, height + margin),
+            Box(-width, -height, width + margin, 3 * height),
+            Box(width - margin, -height, width + margin, 3 * height),
+        ]
+        safe_map = Map(width, height, self.map.start, self.map.goal, [
+            Box(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in compiled_map.expanded_bounds.tolist()
+        ] + border)
+        # the grid planner handles the overlapping boxes at the border, the
+        # approximation algorithm can recurse forever on them
+        path = MapPathFinder.generate_grid_path(safe_map)
+        if path is None:
+            return []
+
+        # walk along the path with steps of step_size, every segment ends
+        # with a shorter step exactly at its checkpoint
+        move_sequence = []
+        for i in range(len(path) - 1):
+            distance = path[i].distance_to_checkpoint(path[i + 1])
+            if distance == 0:
+                continue
+            dx, dy = path[i].direction_to_checkpoint(path[i + 1])
+            n = int(distance // step_size)
+            move_sequence += [(dx, dy)] * n
+
+            remaining = (distance - n * step_size) / step_size
+            if remaining > 0:
+                move_sequence.append((dx * remaining, dy * remaining))
+
+        return move_sequence[:self.solution_length]
+
+    def run_generation(self, visualize):
+        
+        self.simulate_population(visualize)
+        
+        self.population = sorted(self.population, key=lambda bubble: bubble.fitness, reverse=True)
+        
+        best = self.population[0].fitness
+        avg = sum([bubble.fitness for bubble in self.population]) / len(self.population)
+        success = any([bubble.won for bubble in self.population])
+
+        survivors = self.natural_selection()
+        offspring = self.breed(survivors, self.population_size - len(survivors))
+        self.mutate(survivors)
+        
+        self.population = survivors + offspring
+
+        return best, avg, success     
+
     def natural_selection(self):
         
         survivors = self.population[:int(self.population_size / 2)]
@@ -125,32 +243,247 @@ class EvolutionaryAlgorithm():
                     )
 
 
-def start_evolution(generations=100, population_size=1000, mutation_rate=0.05, mutation_strength=0.3, visualize = True):
+class CMAEvolutionStrategy(Optimizer):
+    # CMA-ES over the coefficients of a low frequency cosine basis, every
+    # coordinate of the move sequence is a weighted sum of basis_size cosines
+
+    def __init__(self, map, generations, population_size, basis_size=8, sigma=0.5):
+        super().__init__(map, generations, population_size)
+
+        t = np.arange(self.solution_length)
+        k = np.arange(basis_size)
+        self.basis = np.cos(np.pi * np.outer(t + 0.5, k) / self.solution_length)
+
+        self.dimension = 2 * basis_size
+        self.mean = np.zeros(self.dimension)
+        self.sigma = sigma
+
+        # selection and recombination
+        self.mu = self.population_size // 2
+        weights = np.log(self.mu + 0.5) - np.log(np.arange(1, self.mu + 1))
+        self.weights = weights / np.sum(weights)
+        self.mueff = 1 / np.sum(self.weights**2)
+
+        # adaptation (Hansen, The CMA Evolution Strategy: A Tutorial)
+        n = self.dimension
+        self.cc = (4 + self.mueff / n) / (n + 4 + 2 * self.mueff / n)
+        self.cs = (self.mueff + 2) / (n + self.mueff + 5)
+        self.c1 = 2 / ((n + 1.3)**2 + self.mueff)
+        self.cmu = min(1 - self.c1, 2 * (self.mueff - 2 + 1 / self.mueff) / ((n + 2)**2 + self.mueff))
+        self.damps = 1 + 2 * max(0, np.sqrt((self.mueff - 1) / (n + 1)) - 1) + self.cs
+        self.chi_n = np.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n**2))
+
+        self.pc = np.zeros(n)
+        self.ps = np.zeros(n)
+        self.covariance = np.eye(n)
+        self.eigenvectors = np.eye(n)
+        self.eigenvalues = np.ones(n)
+        self.generation = 0
+
+        # derive the generator from random, so seed() makes runs reproducible
+        self.rng = np.random.default_rng(randint(0, 2**32 - 1))
+
+        self.initialize_population()
+
+    def initialize_population(self):
+        self.samples = self.rng.standard_normal((self.population_size, self.dimension))
+        self.solutions = self.mean + self.sigma * (self.samples * np.sqrt(self.eigenvalues)) @ self.eigenvectors.T
+        self.population = [Bubble(move_sequence=self.decode(solution)) for solution in self.solutions]
+
+    def decode(self, solution):
+        coefficients = solution.reshape(2, -1)
+        moves = self.basis @ coefficients.T
+        return [tuple(move) for move in moves.tolist()]
+
+    def run_generation(self, visualize):
+
+        self.simulate_population(visualize)
+
+        fitness = np.array([bubble.fitness for bubble in self.population])
+        best = np.max(fitness)
+        avg = np.mean(fitness)
+        success = any([bubble.won for bubble in self.population])
+
+        self.update(np.argsort(-fitness, kind="stable"))
+        self.initialize_population()
+
+        return best, avg, success
+
+    def update(self, order):
+        n = self.dimension
+        selected = order[:self.mu]
+
+        old_mean = self.mean
+        self.mean = self.weights @ self.solutions[selected]
+        step = (self.mean - old_mean) / self.sigma
+
+        # evolution paths
+        inverse_sqrt_covariance = self.eigenvectors @ np.diag(1 / np.sqrt(self.eigenvalues)) @ self.eigenvectors.T
+        self.ps = (1 - self.cs) * self.ps + np.sqrt(self.cs * (2 - self.cs) * self.mueff) * inverse_sqrt_covariance @ step
+        self.generation += 1
+        hsig = np.linalg.norm(self.ps) / np.sqrt(1 - (1 - self.cs)**(2 * self.generation)) / self.chi_n < 1.4 + 2 / (n + 1)
+        self.pc = (1 - self.cc) * self.pc + hsig * np.sqrt(self.cc * (2 - self.cc) * self.mueff) * step
+
+        # covariance matrix
+        steps = (self.solutions[selected] - old_mean) / self.sigma
+        rank_one = np.outer(self.pc, self.pc) + (1 - hsig) * self.cc * (2 - self.cc) * self.covariance
+        rank_mu = steps.T @ np.diag(self.weights) @ steps
+        self.covariance = (1 - self.c1 - self.cmu) * self.covariance + self.c1 * rank_one + self.cmu * rank_mu
+
+        # step size
+        self.sigma *= np.exp((self.cs / self.damps) * (np.linalg.norm(self.ps) / self.chi_n - 1))
+
+        self.covariance = np.triu(self.covariance) + np.triu(self.covariance, 1).T
+        self.eigenvalues, self.eigenvectors = np.linalg.eigh(self.covariance)
+        self.eigenvalues = np.maximum(self.eigenvalues, 1e-20)
+
+
+class BackgroundEvolution():
+    # runs an optimizer in a worker thread and publishes a snapshot after every
+    # generation, the queue is bounded and drops the oldest snapshot when it is
+    # full, so a slow consumer never throttles the search
+
+    def __init__(self, optimizer, queue_size=2):
+        self.optimizer = optimizer
+        self.snapshots = Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.result = None
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        # only asks the optimizer to stop after the current generation, so it
+        # can be called from the gui thread without blocking it
+        self.optimizer.stopped = True
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+    @property
+    def running(self):
+        return self.thread.is_alive()
+
+    def latest_snapshot(self):
+        # returns None if there is no new snapshot
+        snapshot = None
+        while True:
+            try:
+                snapshot = self.snapshots.get_nowait()
+            except Empty:
+                return snapshot
+
+    def _run(self):
+        def publish(status):
+            self._publish({
+                "status": status,
+                "bubbles": self.optimizer.last_generation,
+            })
+
+        self.result = self.optimizer.run(status_callback=publish, visualize=False)
+
+    def _publish(self, snapshot):
+        while True:
+            try:
+                self.snapshots.put_nowait(snapshot)
+                return
+            except Full:
+                try:
+                    self.snapshots.get_nowait()
+                except Empty:
+                    pass
+
+
+def create_optimizer(map, generations=100, population_size=1000, mutation_rate=0.05, mutation_strength=0.3, seed_fraction=0, seed_noise=0.2, optimizer="genetic"):
+    if optimizer == "cma":
+        # CMA-ES starts from its mean, it can not be seeded with paths
+        if seed_fraction != 0:
+            raise ValueError("the cma optimizer does not support seed_fraction")
+        return CMAEvolutionStrategy(map, generations, population_size)
+    if optimizer != "genetic":
+        raise ValueError("unknown optimizer {}".format(optimizer))
+    return EvolutionaryAlgorithm(map, generations, population_size, mutation_rate, mutation_strength, seed_fraction, seed_noise)
+
+def start_evolution(generations=100, population_size=1000, mutation_rate=0.05, mutation_strength=0.3, seed_fraction=0, seed_noise=0.2, optimizer="genetic", visualize = True):
 
     map = MapGenerator().generate(1000, 1000)
-    evolution = EvolutionaryAlgorithm(map, generations, population_size, mutation_rate, mutation_strength)
+    evolution = create_optimizer(map, generations, population_size, mutation_rate, mutation_strength, seed_fraction, seed_noise, optimizer)
     
     def update_status(status):
         map.window.status_text = status
 
     return evolution.run(status_callback=update_status if visualize else None, visualize=visualize)
     
+def start_background_evolution(generations=100, population_size=1000, mutation_rate=0.05, mutation_strength=0.3, seed_fraction=0, seed_noise=0.2, optimizer="genetic"):
+
+    map = MapGenerator().generate(1000, 1000)
+    evolution = create_optimizer(map, generations, population_size, mutation_rate, mutation_strength, seed_fraction, seed_noise, optimizer)
+
+    background = BackgroundEvolution(evolution)
+    window = BubbleWindow(map.width, map.height)
+
+    # the window only draws the latest snapshot, the evolution is not blocked by drawing
+    def draw_snapshot(snapshot):
+        map.draw(window.canvas, [])
+        for x, y, radius, color in snapshot["bubbles"]:
+            window.canvas.create_circle(x, y, radius, color=color)
+        window.status_text = snapshot["status"]
+
+    def close():
+        # the worker finishes its current generation after the window is gone
+        background.stop()
+        window.close()
+
+    window.snapshot_function = background.latest_snapshot
+    window.draw_snapshot_function = draw_snapshot
+    window.protocol("WM_DELETE_WINDOW", close)
+
+    background.start()
+    window.start()
+    background.join()
+
+    return background.result
+
 def seeded_evolution(evolution_seed, config):
+    # returns (seed, success generation, evaluations)
     seed(evolution_seed)
-    return (evolution_seed, start_evolution(**config, visualize=False))
+    map = MapGenerator().generate(1000, 1000)
+    evolution = create_optimizer(map, **config)
+    generation = evolution.run(visualize=False)
+    return (evolution_seed, generation, evolution.evaluations)
 
 def benchmark(n, config):
 
     with Pool() as pool:
         results = pool.starmap(seeded_evolution, [(i, config) for i in range(n)])
 
-    best_seed, success_generation = min(results, key=lambda x: x[1])
+    best_seed, success_generation, _ = min(results, key=lambda x: x[1])
     average_generation = sum([result[1] for result in results]) / len(results)
     median_generation = sorted(results, key=lambda x: x[1])[int(len(results) / 2)][1]
+    average_evaluations = sum([result[2] for result in results]) / len(results)
 
     print("Best seed: {} with success generation: {}".format(best_seed, success_generation))
     print("Average generation: {}".format(average_generation))
     print("Median generation: {}".format(median_generation))
+    print("Average evaluations: {}".format(average_evaluations))
+
+def benchmark_seeding(n, config, seed_fraction=0.2):
+
+    # same seeds, so both runs use the same maps
+    print("Random initialization")
+    benchmark(n, config)
+
+    print("Path guided initialization ({:.0f}% seeded)".format(seed_fraction * 100))
+    benchmark(n, {**config, "seed_fraction": seed_fraction})
+
+def benchmark_optimizers(n, config, cma_population_size=100):
+
+    print("Genetic algorithm")
+    benchmark(n, config)
+
+    # CMA-ES works best with a small population
+    print("CMA-ES")
+    benchmark(n, {**config, "population_size": cma_population_size, "optimizer": "cma"})
 
 if __name__ == "__main__":
 
@@ -164,5 +497,8 @@ if __name__ == "__main__":
     
     # seed(43)
     start_evolution(**config, visualize=True)
+    # start_background_evolution(**config)
 
-    # benchmark(100, config)
\ No newline at end of file
+    # benchmark(100, config)
+    # benchmark_seeding(100, config)
+    # benchmark_optimizers(100, config)
\ No newline at end of file
@@ -3,6 +3,12 @@ from tqdm import tqdm
 import numpy as np
 import time
 import json
+import heapq
+import hashlib
+import sqlite3
+import threading
+import os
+from collections import deque, OrderedDict
 
 from bubbles import *
 from window import *
@@ -17,6 +23,7 @@ class Map():
         self.obstacles = obstacles
 
         self.window = None
+        self.observers = [] # get notified about obstacle changes
         
         self.distance_start_to_goal = max(0, self.start.distance_to_checkpoint(self.goal) - self.start.radius - self.goal.radius)
         
@@ -74,6 +81,22 @@ class Map():
             return True
         return False
     
+    def add_obstacle(self, obstacle):
+        self.obstacles.append(obstacle)
+        for observer in self.observers:
+            observer.obstacle_added(obstacle)
+
+    def remove_obstacle(self, obstacle):
+        self.obstacles.remove(obstacle)
+        for observer in self.observers:
+            observer.obstacle_removed(obstacle)
+
+    def move_obstacle(self, obstacle, x, y):
+        self.remove_obstacle(obstacle)
+        obstacle.x = x
+        obstacle.y = y
+        self.add_obstacle(obstacle)
+
     def point_in_bounds(self, x, y):
         return x >= 0 and x <= self.width and y >= 0 and y <= self.height
     
@@ -99,6 +122,264 @@ class Map():
         for i in range(len(path) - 1):
             canvas.create_line(path[i].x, path[i].y, path[i + 1].x, path[i + 1].y, fill="red", width=10, arrow=tk.LAST)
 
+    def compile(self, radius=5, cell_size=5):
+        return CompiledMap(self, radius, cell_size)
+
+
+class CompiledMap(Map):
+    # immutable version of a map, where the obstacles are preprocessed and
+    # stored in flat arrays instead of Box objects
+
+    def __init__(self, map, radius=5, cell_size=5):
+        bounds = np.array([
+            [obstacle.x, obstacle.y, obstacle.x + obstacle.width, obstacle.y + obstacle.height]
+            for obstacle in map.obstacles
+        ], dtype=float).reshape(-1, 4)
+
+        bounds = CompiledMap._merge_boxes(bounds)
+        bounds = CompiledMap._drop_unreachable_boxes(bounds, map, cell_size)
+
+        # sort the boxes, so the same geometry always results in the same arrays
+        bounds = bounds[np.lexsort(bounds.T[::-1])] if len(bounds) > 0 else bounds
+        bounds.flags.writeable = False
+
+        obstacles = tuple(Box(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in bounds.tolist())
+        super().__init__(map.width, map.height, map.start, map.goal, obstacles)
+
+        self.radius = radius
+        self.bounds = bounds # x0, y0, x1, y1
+        self.corners = np.stack([
+            bounds[:, [0, 1]],
+            bounds[:, [2, 1]],
+            bounds[:, [2, 3]],
+            bounds[:, [0, 3]],
+        ], axis=1)
+        self.expanded_bounds = bounds + np.array([-radius, -radius, radius, radius])
+        self.corners.flags.writeable = False
+        self.expanded_bounds.flags.writeable = False
+
+        self.content_hash = self._hash()
+
+    def add_obstacle(self, obstacle):
+        raise TypeError("a compiled map is immutable")
+
+    def remove_obstacle(self, obstacle):
+        raise TypeError("a compiled map is immutable")
+
+    def move_obstacle(self, obstacle, x, y):
+        raise TypeError("a compiled map is immutable")
+
+    def check_collisions(self, bubbles):
+        # check all bubbles against all obstacles at once, in chunks to limit the memory
+        chunk_size = max(1, 1000000 // max(1, len(self.bounds)))
+        for i in range(0, len(bubbles), chunk_size):
+            chunk = bubbles[i:i + chunk_size]
+            obstacle_collisions = self.obstacles_collisions(
+                np.array([bubble.x for bubble in chunk]),
+                np.array([bubble.y for bubble in chunk]),
+                np.array([bubble.radius for bubble in chunk]),
+            )
+
+            for bubble, obstacle_collision in zip(chunk, obstacle_collisions):
+                if obstacle_collision or self.bubble_border_collision(bubble):
+                    bubble.color = "red"
+                    bubble.disabled = True
+                if self.bubble_goal_collision(bubble):
+                    bubble.color = "green"
+                    bubble.disabled = True
+                    bubble.won = True
+
+    def bubble_obstacles_collision(self, bubble):
+        return bool(self.obstacles_collisions(np.array([bubble.x]), np.array([bubble.y]), np.array([bubble.radius]))[0])
+
+    def obstacles_collisions(self, x, y, radius):
+        x = x[:, None]
+        y = y[:, None]
+        dx = np.maximum(np.maximum(self.bounds[:, 0] - x, 0), x - self.bounds[:, 2])
+        dy = np.maximum(np.maximum(self.bounds[:, 1] - y, 0), y - self.bounds[:, 3])
+        return np.any(dx**2 + dy**2 < radius[:, None]**2, axis=1)
+
+    def _hash(self):
+        return CompiledMap.geometry_hash(self.width, self.height, self.start, self.goal, self.bounds)
+
+    @staticmethod
+    def geometry_hash(width, height, start, goal, bounds):
+        # canonical hash of a map, all numbers are compared as floats and the
+        # order of the boxes (x0, y0, x1, y1) does not matter
+        bounds = np.array(bounds, dtype=np.float64).reshape(-1, 4)
+        bounds = bounds[np.lexsort(bounds.T[::-1])] if len(bounds) > 0 else bounds
+        content = np.concatenate([
+            np.array([width, height, start.x, start.y, goal.x, goal.y], dtype=np.float64),
+            bounds.flatten(),
+        ])
+        return hashlib.sha256(content.tobytes()).hexdigest()
+
+    @staticmethod
+    def _merge_boxes(bounds):
+        # merge boxes that are contained in another box or that form a box
+        # together, as the union of other overlapping boxes is not a box
+        changed = True
+        while changed:
+            size = len(bounds)
+            bounds = CompiledMap._drop_contained_boxes(bounds)
+            bounds = CompiledMap._merge_aligned_boxes(bounds, axis=0)
+            bounds = CompiledMap._merge_aligned_boxes(bounds, axis=1)
+            changed = len(bounds) < size
+        return bounds
+
+    @staticmethod
+    def _drop_contained_boxes(bounds):
+        # sort by area, so a box can only be contained in a box before it
+        areas = (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1])
+        bounds = bounds[np.argsort(-areas, kind="stable")]
+
+        keep = np.ones(len(bounds), dtype=bool)
+        chunk_size = 1000
+        for i in range(0, len(bounds), chunk_size):
+            chunk = bounds[i:i + chunk_size, None, :]
+            contained = (bounds[:, 0] <= chunk[..., 0]) & (bounds[:, 1] <= chunk[..., 1]) & (bounds[:, 2] >= chunk[..., 2]) & (bounds[:, 3] >= chunk[..., 3])
+            # a box does not contain itself and identical boxes only drop the later ones
+            contained &= np.arange(len(bounds)) < np.arange(i, i + len(chunk))[:, None]
+            keep[i:i + chunk_size] = ~np.any(contained, axis=1)
+        return bounds[keep]
+
+    @staticmethod
+    def _merge_aligned_boxes(bounds, axis):
+        # boxes with the same extent on one axis, that overlap or touch on the
+        # other axis are merged (axis 0: same x extent, merge along y)
+        low, high = (1, 3) if axis == 0 else (0, 2)
+        same_low, same_high = (0, 2) if axis == 0 else (1, 3)
+
+        groups = {}
+        for box in bounds.tolist():
+            groups.setdefault((box[same_low], box[same_high]), []).append(box)
+
+        merged = []
+        for group in groups.values():
+            group.sort(key=lambda box: box[low])
+            current = group[0]
+            for box in group[1:]:
+                if box[low] <= current[high]:
+                    current[high] = max(current[high], box[high])
+                else:
+                    merged.append(current)
+                    current = box
+            merged.append(current)
+        return np.array(merged, dtype=float).reshape(-1, 4)
+
+    @staticmethod
+    def _drop_unreachable_boxes(bounds, map, cell_size):
+        # flood fill the free space from the start, a cell is only blocked if it
+        # is fully covered by an obstacle, so the reachable space is never underestimated
+        if len(bounds) == 0:
+            return bounds
+
+        cols = int(np.ceil(map.width / cell_size))
+        rows = int(np.ceil(map.height / cell_size))
+        blocked = np.zeros((rows, cols), dtype=bool)
+        for x0, y0, x1, y1 in bounds:
+            # boxes may reach outside of the map, negative indices would wrap around
+            row0, row1 = np.clip([np.ceil(y0 / cell_size), y1 // cell_size], 0, rows).astype(int)
+            col0, col1 = np.clip([np.ceil(x0 / cell_size), x1 // cell_size], 0, cols).astype(int)
+            blocked[row0:row1, col0:col1] = True
+
+        reachable = np.zeros((rows, cols), dtype=bool)
+        open_cells = deque()
+        for checkpoint in [map.start, map.goal]:
+            cell = (min(int(checkpoint.y // cell_size), rows - 1), min(int(checkpoint.x // cell_size), cols - 1))
+            if not blocked[cell] and not reachable[cell]:
+                reachable[cell] = True
+                open_cells.append(cell)
+
+        while len(open_cells) > 0:
+            row, col = open_cells.popleft()
+            for d_row, d_col in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+                neighbor = (row + d_row, col + d_col)
+                if 0 <= neighbor[0] < rows and 0 <= neighbor[1] < cols and not blocked[neighbor] and not reachable[neighbor]:
+                    reachable[neighbor] = True
+                    open_cells.append(neighbor)
+
+        # a box is reachable, if any cell it touches is reachable
+        keep = np.zeros(len(bounds), dtype=bool)
+        for i, (x0, y0, x1, y1) in enumerate(bounds):
+            rows_slice = slice(max(int(np.ceil(y0 / cell_size)) - 1, 0), max(int(y1 // cell_size) + 1, 0))
+            cols_slice = slice(max(int(np.ceil(x0 / cell_size)) - 1, 0), max(int(x1 // cell_size) + 1, 0))
+            keep[i] = np.any(reachable[rows_slice, cols_slice])
+        return bounds[keep]
+
+class MapBatch():
+    # simulates a population on many maps at once, vectorized over bubbles,
+    # maps and obstacles, the obstacles are taken from the compiled maps
+
+    def __init__(self, maps, radius=5):
+        self.maps = [map if isinstance(map, CompiledMap) else map.compile(radius) for map in maps]
+
+        # pad the obstacles of all maps to the same number, padded boxes are infinitely far away
+        n_obstacles = max(1, max(len(map.bounds) for map in self.maps))
+        self.bounds = np.full((len(self.maps), n_obstacles, 4), np.inf)
+        for i, map in enumerate(self.maps):
+            self.bounds[i, :len(map.bounds)] = map.bounds
+
+        self.sizes = np.array([[map.width, map.height] for map in self.maps], dtype=float)
+        self.starts = np.array([[map.start.x, map.start.y] for map in self.maps], dtype=float)
+        self.goals = np.array([[map.goal.x, map.goal.y] for map in self.maps], dtype=float)
+        self.goal_radii = np.array([map.goal.radius for map in self.maps], dtype=float)
+        self.distance_start_to_goal = np.array([map.distance_start_to_goal for map in self.maps], dtype=float)
+
+    def __len__(self):
+        return len(self.maps)
+
+    def simulate(self, bubbles):
+        # returns the distances to the goals, if the goals were reached and the
+        # final positions, with the shapes (bubbles, maps) and (bubbles, maps, 2)
+        n_steps = max(len(bubble.move_sequence) for bubble in bubbles)
+        moves = np.zeros((len(bubbles), n_steps, 2))
+        for i, bubble in enumerate(bubbles):
+            if len(bubble.move_sequence) > 0:
+                moves[i, :len(bubble.move_sequence)] = bubble.move_sequence
+        moves *= np.array([bubble.step_size for bubble in bubbles])[:, None, None]
+        radii = np.array([bubble.radius for bubble in bubbles], dtype=float)
+
+        distances = np.zeros((len(bubbles), len(self.maps)))
+        won = np.zeros((len(bubbles), len(self.maps)), dtype=bool)
+        positions = np.zeros((len(bubbles), len(self.maps), 2))
+
+        # limit the memory of the bubbles x maps x obstacles arrays
+        chunk_size = max(1, 2000000 // (len(self.maps) * self.bounds.shape[1]))
+        for i in range(0, len(bubbles), chunk_size):
+            chunk = slice(i, i + chunk_size)
+            distances[chunk], won[chunk], positions[chunk] = self._simulate_chunk(moves[chunk], radii[chunk])
+
+        return distances, won, positions
+
+    def _simulate_chunk(self, moves, radii):
+        n_bubbles = len(moves)
+        positions = np.broadcast_to(self.starts, (n_bubbles, len(self.maps), 2)).copy()
+        active = np.ones((n_bubbles, len(self.maps)), dtype=bool)
+        won = np.zeros((n_bubbles, len(self.maps)), dtype=bool)
+        r = radii[:, None]
+
+        for step in range(moves.shape[1]):
+            if not np.any(active):
+                break
+            positions += moves[:, None, step] * active[..., None]
+
+            x = positions[..., 0]
+            y = positions[..., 1]
+            border_collision = (x - r < 0) | (x + r > self.sizes[:, 0]) | (y - r < 0) | (y + r > self.sizes[:, 1])
+
+            dx = np.maximum(np.maximum(self.bounds[..., 0] - x[..., None], 0), x[..., None] - self.bounds[..., 2])
+            dy = np.maximum(np.maximum(self.bounds[..., 1] - y[..., None], 0), y[..., None] - self.bounds[..., 3])
+            obstacle_collision = np.any(dx**2 + dy**2 < r[..., None]**2, axis=2)
+
+            goal_distance = np.linalg.norm(positions - self.goals, axis=2)
+            goal_collision = goal_distance < r + self.goal_radii
+
+            won |= active & goal_collision
+            active &= ~(border_collision | obstacle_collision | goal_collision)
+
+        distances = np.maximum(0, np.linalg.norm(positions - self.goals, axis=2) - r - self.goal_radii)
+        return distances, won, positions
 
 class Box():
     def __init__(self, x, y, width, height, color="black"):
@@ -224,6 +505,20 @@ class MapGenerator():
 
         return obstacles
     
+    @staticmethod
+    def generate_dense(width, height, n=10000, max_obstacle_size=5):
+        # random, possibly overlapping obstacles that keep the start and goal free
+        start, goal = MapGenerator.generate_start_goal(width, height)
+
+        obstacles = []
+        while len(obstacles) < n:
+            obstacle = Box(randint(0, width), randint(0, height), randint(1, max_obstacle_size), randint(1, max_obstacle_size))
+            if obstacle.distance_to(start.x, start.y) <= start.radius or obstacle.distance_to(goal.x, goal.y) <= goal.radius:
+                continue
+            obstacles.append(obstacle)
+
+        return Map(width, height, start, goal, obstacles)
+
     @staticmethod
     def generate_valid_position(map):
         while True:
@@ -242,23 +537,14 @@ class MapGenerator():
 class MapPathFinder():
     
     @staticmethod
-    def generate_optimal_path_from(map, x, y):
+    def generate_optimal_path_from(map, x, y, cache=None):
         safe_map = Map(map.width, map.height, Checkpoint(x, y), map.goal, map.obstacles)
-        return MapPathFinder.generate_optimal_path(safe_map)
+        return MapPathFinder.generate_optimal_path(safe_map, cache)
 
     @staticmethod
-    def generate_optimal_path(map):
+    def generate_optimal_path(map, cache=None):
         # use A* to find the optimal path
-        def get_checkpoints_from_obstacle(obstacle):
-            offset = 1
-            return [
-                Checkpoint(obstacle.x - offset, obstacle.y - offset),
-                Checkpoint(obstacle.x + obstacle.width + offset, obstacle.y - offset),
-                Checkpoint(obstacle.x + obstacle.width + offset, obstacle.y + obstacle.height + offset),
-                Checkpoint(obstacle.x - offset, obstacle.y + obstacle.height + offset),
-            ]
-
-        checkpoints = [map.start, map.goal] + [checkpoint for obstacle in map.obstacles for checkpoint in get_checkpoints_from_obstacle(obstacle)] 
+        checkpoints = [map.start, map.goal] + [checkpoint for corners in MapPathFinder._get_corner_checkpoints(map) for checkpoint in corners] 
 
 
         open_set = [map.start]
@@ -269,7 +555,8 @@ class MapPathFinder():
         g_score[map.start] = 0
 
         f_score = {checkpoint: float("inf") for checkpoint in checkpoints}
-        f_score[map.start] = MapPathFinder.calculate_path_length(MapPathFinder.generate_approx_path(map))
+        approx_path = MapPathFinder.generate_approx_path(map) if cache is None else cache.generate_path(map, "approx")
+        f_score[map.start] = MapPathFinder.calculate_path_length(approx_path)
 
         while len(open_set) > 0:
             current = min(open_set, key=lambda checkpoint: f_score[checkpoint])
@@ -289,6 +576,24 @@ class MapPathFinder():
 
         return None
     
+    @staticmethod
+    def _get_corner_checkpoints(map):
+        # checkpoints at the corners of every obstacle, with an offset of 1 away from the obstacle
+        if isinstance(map, CompiledMap):
+            offset = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]])
+            return [[Checkpoint(x, y) for x, y in corners] for corners in (map.corners + offset).tolist()]
+        return [MapPathFinder._get_corner_checkpoints_of(obstacle) for obstacle in map.obstacles]
+
+    @staticmethod
+    def _get_corner_checkpoints_of(obstacle):
+        offset = 1
+        return [
+            Checkpoint(obstacle.x - offset, obstacle.y - offset),
+            Checkpoint(obstacle.x + obstacle.width + offset, obstacle.y - offset),
+            Checkpoint(obstacle.x + obstacle.width + offset, obstacle.y + obstacle.height + offset),
+            Checkpoint(obstacle.x - offset, obstacle.y + obstacle.height + offset),
+        ]
+
     @staticmethod
     def _reconstruct_path(came_from, current):
         total_path = [current]
@@ -360,6 +665,171 @@ class MapPathFinder():
             else:
                 i += 1 
         return path
+
+    @staticmethod
+    def generate_grid_path_from(map, x, y, cell_size=10, min_cell_size=1):
+        safe_map = Map(map.width, map.height, Checkpoint(x, y), map.goal, map.obstacles)
+        return MapPathFinder.generate_grid_path(safe_map, cell_size, min_cell_size)
+
+    @staticmethod
+    def generate_grid_path(map, cell_size=10, min_cell_size=1):
+        # use Theta* on a rasterized occupancy grid, the runtime depends on the
+        # grid size instead of the number of obstacles. Narrow gaps are closed
+        # on a coarse grid, so the grid is refined until a path is found
+        while cell_size >= min_cell_size:
+            path = MapPathFinder._generate_grid_path(map, cell_size)
+            if path is not None:
+                return path
+            cell_size /= 2
+        return None
+
+    @staticmethod
+    def _generate_grid_path(map, cell_size):
+        grid = MapPathFinder._rasterize(map, cell_size)
+        rows, cols = grid.shape
+
+        def to_cell(x, y):
+            return (min(max(int(x // cell_size), 0), cols - 1), min(max(int(y // cell_size), 0), rows - 1))
+
+        start_cell = to_cell(map.start.x, map.start.y)
+        goal_cell = to_cell(map.goal.x, map.goal.y)
+
+        # start and goal are valid positions, even if their cell overlaps an obstacle
+        grid[start_cell[1], start_cell[0]] = False
+        grid[goal_cell[1], goal_cell[0]] = False
+
+        if start_cell == goal_cell:
+            return [map.start, map.goal]
+
+        def position(cell):
+            if cell == start_cell:
+                return map.start.x, map.start.y
+            if cell == goal_cell:
+                return map.goal.x, map.goal.y
+            return (cell[0] + 0.5) * cell_size, (cell[1] + 0.5) * cell_size
+
+        def distance(cell1, cell2):
+            x1, y1 = position(cell1)
+            x2, y2 = position(cell2)
+            return ((x1 - x2)**2 + (y1 - y2)**2)**0.5
+
+        def line_of_sight(cell1, cell2):
+            return MapPathFinder._grid_line_of_sight(grid, cell_size, *position(cell1), *position(cell2))
+
+        came_from = {start_cell: start_cell}
+        g_score = {start_cell: 0}
+        closed_set = set()
+
+        counter = 0 # tie breaker, so cells never get compared
+        open_heap = [(distance(start_cell, goal_cell), counter, start_cell)]
+
+        while len(open_heap) > 0:
+            _, _, current = heapq.heappop(open_heap)
+            if current in closed_set:
+                continue
+            if current == goal_cell:
+                path = MapPathFinder._reconstruct_grid_path(came_from, current)
+                return [map.start] + [Checkpoint(*position(cell)) for cell in path[1:-1]] + [map.goal]
+
+            closed_set.add(current)
+
+            for neighbor in MapPathFinder._get_grid_neighbors(current, grid):
+                if neighbor in closed_set:
+                    continue
+
+                # Theta*: connect to the parent of the current cell directly if it is visible
+                parent = came_from[current]
+                if line_of_sight(parent, neighbor):
+                    tentative_g_score = g_score[parent] + distance(parent, neighbor)
+                else:
+                    parent = current
+                    tentative_g_score = g_score[current] + distance(current, neighbor)
+
+                if tentative_g_score < g_score.get(neighbor, float("inf")):
+                    came_from[neighbor] = parent
+                    g_score[neighbor] = tentative_g_score
+                    counter += 1
+                    heapq.heappush(open_heap, (tentative_g_score + distance(neighbor, goal_cell), counter, neighbor))
+
+        return None
+
+    @staticmethod
+    def _rasterize(map, cell_size):
+        # a cell is blocked if any obstacle overlaps it, touching its edge is not enough
+        cols = int(np.ceil(map.width / cell_size))
+        rows = int(np.ceil(map.height / cell_size))
+        grid = np.zeros((rows, cols), dtype=bool)
+
+        for obstacle in map.obstacles:
+            x0 = max(int(obstacle.x // cell_size), 0)
+            y0 = max(int(obstacle.y // cell_size), 0)
+            x1 = min(int(np.ceil((obstacle.x + obstacle.width) / cell_size)), cols)
+            y1 = min(int(np.ceil((obstacle.y + obstacle.height) / cell_size)), rows)
+            grid[y0:y1, x0:x1] = True
+
+        return grid
+
+    @staticmethod
+    def _get_grid_neighbors(cell, grid):
+        rows, cols = grid.shape
+        x, y = cell
+        neighbors = []
+        for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (1, -1), (1, 1), (-1, 1)]:
+            nx, ny = x + dx, y + dy
+            if nx < 0 or nx >= cols or ny < 0 or ny >= rows or grid[ny, nx]:
+                continue
+            # do not cut corners of blocked cells
+            if dx != 0 and dy != 0 and (grid[y, nx] or grid[ny, x]):
+                continue
+            neighbors.append((nx, ny))
+        return neighbors
+
+    @staticmethod
+    def _reconstruct_grid_path(came_from, current):
+        total_path = [current]
+        while came_from[current] != current:
+            current = came_from[current]
+            total_path.append(current)
+        return total_path[::-1]
+
+    @staticmethod
+    def _grid_line_of_sight(grid, cell_size, x0, y0, x1, y1):
+        # walk all cells the line passes through (Amanatides & Woo)
+        rows, cols = grid.shape
+        cx, cy = min(int(x0 // cell_size), cols - 1), min(int(y0 // cell_size), rows - 1)
+        end_cx, end_cy = min(int(x1 // cell_size), cols - 1), min(int(y1 // cell_size), rows - 1)
+
+        dx, dy = x1 - x0, y1 - y0
+        step_x = 1 if dx > 0 else -1
+        step_y = 1 if dy > 0 else -1
+
+        t_delta_x = cell_size / abs(dx) if dx != 0 else float("inf")
+        t_delta_y = cell_size / abs(dy) if dy != 0 else float("inf")
+        t_max_x = ((cx + (step_x > 0)) * cell_size - x0) / dx if dx != 0 else float("inf")
+        t_max_y = ((cy + (step_y > 0)) * cell_size - y0) / dy if dy != 0 else float("inf")
+
+        for _ in range(abs(end_cx - cx) + abs(end_cy - cy) + 1):
+            if grid[cy, cx]:
+                return False
+            if cx == end_cx and cy == end_cy:
+                return True
+
+            if t_max_x < t_max_y:
+                cx += step_x
+                t_max_x += t_delta_x
+            elif t_max_y < t_max_x:
+                cy += step_y
+                t_max_y += t_delta_y
+            else:
+                # the line passes exactly through a corner, both side cells must be free
+                if grid[cy, cx + step_x] or grid[cy + step_y, cx]:
+                    return False
+                cx += step_x
+                cy += step_y
+                t_max_x += t_delta_x
+                t_max_y += t_delta_y
+
+        return not grid[end_cy, end_cx]
     
     @staticmethod
     def _find_all_collisions(start, goal, obstacles):
@@ -484,6 +954,30 @@ class MapPathFinder():
         if s >= 0 and s <= 1 and t >= 0 and t <= 1:
             return p1 + s * v1        
         return None
+
+    @staticmethod
+    def _segment_intersects_box(start, goal, obstacle):
+        # clip the line from start to goal with the obstacle (Liang & Barsky),
+        # much faster than checking every side with _find_collision
+        dx = goal.x - start.x
+        dy = goal.y - start.y
+        t0, t1 = 0, 1
+        for p, q in [
+            (-dx, start.x - obstacle.x),
+            (dx, obstacle.x + obstacle.width - start.x),
+            (-dy, start.y - obstacle.y),
+            (dy, obstacle.y + obstacle.height - start.y),
+        ]:
+            if p == 0:
+                if q < 0:
+                    return False
+            elif p < 0:
+                t0 = max(t0, q / p)
+            else:
+                t1 = min(t1, q / p)
+            if t0 > t1:
+                return False
+        return True
         
     @staticmethod
     def calculate_path_length(path):
@@ -493,6 +987,354 @@ class MapPathFinder():
         return length
 
 
+class DynamicMapPathFinder():
+    # D* Lite on the visibility graph of the map, the graph is updated
+    # incrementally when obstacles of the map are added, removed or moved and
+    # the previous solution is repaired instead of planning from scratch
+
+    def __init__(self, map):
+        self.map = map
+        map.observers.append(self)
+
+        self.start = map.start
+        self.last_start = map.start
+        self.km = 0
+
+        self.edges = {} # node -> {neighbor: cost} of all visible edges
+        self.blockers = {} # (node, node) -> obstacles that block the edge
+        self.blocked_edges = {} # obstacle -> edges it blocks
+        self.corners = {} # obstacle -> checkpoints around it
+
+        self.g_score = {}
+        self.rhs_score = {}
+        self.open_keys = {}
+        self.open_heap = []
+        self.counter = 0 # tie breaker, so nodes never get compared
+
+        for node in [map.start, map.goal]:
+            self._add_node(node)
+        for obstacle, corners in zip(map.obstacles, MapPathFinder._get_corner_checkpoints(map)):
+            self._add_corners(obstacle, corners)
+
+        self.rhs_score[map.goal] = 0
+        self._push(map.goal)
+
+    def detach(self):
+        # stop receiving obstacle changes of the map
+        if self in self.map.observers:
+            self.map.observers.remove(self)
+
+    def generate_path(self):
+        self._compute_shortest_path()
+
+        if self.g_score[self.start] == float("inf"):
+            return None
+
+        path = [self.start]
+        current = self.start
+        while current != self.map.goal:
+            current = min(self.edges[current], key=lambda neighbor: self.edges[current][neighbor] + self.g_score[neighbor])
+            path.append(current)
+        return path
+
+    def generate_path_from(self, x, y):
+        # check before km is changed, a non finite start would corrupt all keys
+        if not (np.isfinite(x) and np.isfinite(y)):
+            raise ValueError("start ({}, {}) is not finite".format(x, y))
+
+        start = Checkpoint(x, y)
+        self.km += self.last_start.distance_to_checkpoint(start)
+        self.last_start = start
+
+        old_start = self.start
+        self.start = start
+        changed = self._add_node(start) | self._remove_node(old_start)
+        self._update_vertices(changed)
+
+        return self.generate_path()
+
+    def obstacle_added(self, obstacle):
+        changed = set()
+
+        # only edges crossing the new obstacle are invalidated
+        for edge, blockers in self.blockers.items():
+            if not MapPathFinder._segment_intersects_box(edge[0], edge[1], obstacle):
+                continue
+            if len(blockers) == 0:
+                self._disconnect(*edge)
+                changed.update(edge)
+            blockers.add(obstacle)
+            self.blocked_edges.setdefault(obstacle, set()).add(edge)
+
+        changed |= self._add_corners(obstacle, MapPathFinder._get_corner_checkpoints_of(obstacle))
+        self._update_vertices(changed)
+
+    def obstacle_removed(self, obstacle):
+        changed = set()
+
+        for corner in self.corners.pop(obstacle):
+            changed |= self._remove_node(corner)
+
+        # only edges that were blocked by the obstacle can become visible
+        for edge in self.blocked_edges.pop(obstacle, set()):
+            blockers = self.blockers[edge]
+            blockers.discard(obstacle)
+            if len(blockers) == 0:
+                self._connect(*edge)
+                changed.update(edge)
+
+        self._update_vertices(changed)
+
+    def _add_corners(self, obstacle, corners):
+        self.corners[obstacle] = corners
+
+        changed = set()
+        for corner in self.corners[obstacle]:
+            changed |= self._add_node(corner)
+        return changed
+
+    def _add_node(self, node):
+        changed = {node}
+        others = list(self.edges.keys())
+
+        self.edges[node] = {}
+        self.g_score[node] = float("inf")
+        self.rhs_score[node] = float("inf")
+
+        for other in others:
+            edge = (node, other)
+            blockers = {obstacle for obstacle in self.map.obstacles if MapPathFinder._segment_intersects_box(node, other, obstacle)}
+            self.blockers[edge] = blockers
+            for obstacle in blockers:
+                self.blocked_edges.setdefault(obstacle, set()).add(edge)
+            if len(blockers) == 0:
+                self._connect(node, other)
+                changed.add(other)
+        return changed
+
+    def _remove_node(self, node):
+        changed = set(self.edges[node].keys())
+        for neighbor in changed:
+            del self.edges[neighbor][node]
+
+        for other in self.edges:
+            for edge in [(node, other), (other, node)]:
+                for obstacle in self.blockers.pop(edge, set()):
+                    self.blocked_edges[obstacle].discard(edge)
+
+        del self.edges[node]
+        del self.g_score[node]
+        del self.rhs_score[node]
+        self.open_keys.pop(node, None)
+        return changed
+
+    def _connect(self, node1, node2):
+        cost = node1.distance_to_checkpoint(node2)
+        self.edges[node1][node2] = cost
+        self.edges[node2][node1] = cost
+
+    def _disconnect(self, node1, node2):
+        del self.edges[node1][node2]
+        del self.edges[node2][node1]
+
+    def _calculate_key(self, node):
+        score = min(self.g_score[node], self.rhs_score[node])
+        return (score + node.distance_to_checkpoint(self.start) + self.km, score)
+
+    def _push(self, node):
+        key = self._calculate_key(node)
+        self.open_keys[node] = key
+        self.counter += 1
+        heapq.heappush(self.open_heap, (key, self.counter, node))
+
+    def _top_key(self):
+        # drop outdated heap entries
+        while len(self.open_heap) > 0:
+            key, _, node = self.open_heap[0]
+            if self.open_keys.get(node) == key:
+                return key
+            heapq.heappop(self.open_heap)
+        return (float("inf"), float("inf"))
+
+    def _update_vertices(self, nodes):
+        for node in nodes:
+            if node in self.edges:
+                self._update_vertex(node)
+
+    def _update_vertex(self, node):
+        if node != self.map.goal:
+            self.rhs_score[node] = min([cost + self.g_score[neighbor] for neighbor, cost in self.edges[node].items()], default=float("inf"))
+
+        self.open_keys.pop(node, None)
+        if self.g_score[node] != self.rhs_score[node]:
+            self._push(node)
+
+    def _compute_shortest_path(self):
+        while self._top_key() < self._calculate_key(self.start) or self.rhs_score[self.start] != self.g_score[self.start]:
+            old_key, _, current = heapq.heappop(self.open_heap)
+            del self.open_keys[current]
+
+            if old_key < self._calculate_key(current):
+                self._push(current)
+            elif self.g_score[current] > self.rhs_score[current]:
+                self.g_score[current] = self.rhs_score[current]
+                self._update_vertices(self.edges[current])
+            else:
+                self.g_score[current] = float("inf")
+                self._update_vertices([current] + list(self.edges[current]))
+
+
+class PathCache():
+    # two level cache for path finding results, an in-process LRU cache and an
+    # optional sqlite file, which can be shared between processes (e.g. Pool workers)
+
+    algorithms = {
+        "optimal": MapPathFinder.generate_optimal_path,
+        "approx": MapPathFinder.generate_approx_path,
+        "grid": MapPathFinder.generate_grid_path,
+    }
+
+    def __init__(self, max_size=1000, filename=None, max_file_size=100000, eviction_interval=100):
+        self.max_size = max_size
+        self.filename = filename
+        self.max_file_size = max_file_size
+        self.eviction_interval = eviction_interval # the file is only checked for eviction every n puts
+        self.puts = 0
+
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.file_hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._local = threading.local() # sqlite connections of the current thread
+
+    def __getstate__(self):
+        # locks and connections can not be shared with other processes
+        state = self.__dict__.copy()
+        del state["_lock"]
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def generate_path(self, map, algorithm="optimal", **kwargs):
+        key = PathCache.key(map, algorithm, **kwargs)
+
+        found, points = self.get(key)
+        if not found:
+            path = PathCache.algorithms[algorithm](map, **kwargs)
+            points = None if path is None else [(checkpoint.x, checkpoint.y) for checkpoint in path]
+            self.put(key, points)
+
+        if points is None:
+            return None
+        # keep the start and goal of the map, so the path can be drawn as usual
+        return [map.start] + [Checkpoint(x, y) for x, y in points[1:-1]] + [map.goal]
+
+    def get(self, key):
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, self.entries[key]
+
+        if self.filename is not None:
+            connection = self._get_connection()
+            row = connection.execute("SELECT path FROM paths WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                with connection:
+                    connection.execute("UPDATE paths SET last_used = ? WHERE key = ?", (time.time(), key))
+                points = json.loads(row[0])
+                with self._lock:
+                    self.file_hits += 1
+                    self._put_memory(key, points)
+                return True, points
+
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def put(self, key, points):
+        with self._lock:
+            self._put_memory(key, points)
+
+        if self.filename is not None:
+            connection = self._get_connection()
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO paths (key, path, last_used) VALUES (?, ?, ?)", (key, json.dumps(points), time.time()))
+
+            with self._lock:
+                self.puts += 1
+                evict = self.puts % self.eviction_interval == 0
+            if evict:
+                self._evict_file(connection)
+
+    def _evict_file(self, connection):
+        # remove the least recently used paths, if the file has grown over its size
+        with connection:
+            size = connection.execute("SELECT COUNT(*) FROM paths").fetchone()[0]
+            if size > self.max_file_size:
+                connection.execute(
+                    "DELETE FROM paths WHERE key IN (SELECT key FROM paths ORDER BY last_used LIMIT ?)",
+                    (size - self.max_file_size,),
+                )
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+        if self.filename is not None:
+            connection = self._get_connection()
+            with connection:
+                connection.execute("DELETE FROM paths")
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.file_hits + self.misses
+            return {
+                "hits": self.hits,
+                "file_hits": self.file_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.file_hits) / requests if requests > 0 else 0,
+                "size": len(self.entries),
+            }
+
+    def _put_memory(self, key, points):
+        self.entries[key] = points
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def _get_connection(self):
+        # every process and thread needs its own connection, forked processes
+        # inherit the thread local data, so the pid is checked as well
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.connection = sqlite3.connect(self.filename, timeout=60)
+            self._local.pid = os.getpid()
+            with self._local.connection:
+                self._local.connection.execute("CREATE TABLE IF NOT EXISTS paths (key TEXT PRIMARY KEY, path TEXT, last_used REAL)")
+                self._local.connection.execute("CREATE INDEX IF NOT EXISTS paths_last_used ON paths (last_used)")
+        return self._local.connection
+
+    @staticmethod
+    def key(map, algorithm, **kwargs):
+        # the same canonical map hash as CompiledMap.content_hash
+        if isinstance(map, CompiledMap):
+            map_hash = map.content_hash
+        else:
+            bounds = [[obstacle.x, obstacle.y, obstacle.x + obstacle.width, obstacle.y + obstacle.height] for obstacle in map.obstacles]
+            map_hash = CompiledMap.geometry_hash(map.width, map.height, map.start, map.goal, bounds)
+
+        arguments = {
+            name: float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+            for name, value in kwargs.items()
+        }
+        content = json.dumps({"map": map_hash, "algorithm": algorithm, "arguments": arguments}, sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()
+
 class MapFileHandler():
     
     @staticmethod
@@ -549,6 +1391,9 @@ def benchmark_path_finding(n = 100):
     absolute_time_optimal = np.array([])
     absolute_time_approx = np.array([])
 
+    absolute_time_grid_dense = np.array([])
+    failures_grid_dense = 0
+
     seed(0)
 
     for _ in tqdm(range(n)):
@@ -569,6 +1414,16 @@ def benchmark_path_finding(n = 100):
         absolute_time_approx = np.append(absolute_time_approx, end - start)
         absolute_distance_approx = np.append(absolute_distance_approx, MapPathFinder.calculate_path_length(path))
 
+        # benchmark grid path generation on dense maps, with the default cell size
+        map = MapGenerator.generate_dense(1000, 1000)
+        start = time.perf_counter()
+        path = MapPathFinder.generate_grid_path(map)
+        end = time.perf_counter()
+
+        absolute_time_grid_dense = np.append(absolute_time_grid_dense, end - start)
+        if path is None:
+            failures_grid_dense += 1
+
     # print average time and distance
     print("Optimal path generation took on average", np.average(absolute_time_optimal), "seconds")
     print("Approx path generation took on average", np.average(absolute_time_approx), "seconds")
@@ -581,7 +1436,43 @@ def benchmark_path_finding(n = 100):
 
     # calculate how much longer the approx path is on average compared to the optimal path
     print("Approx path is on average", np.average(absolute_distance_approx) / np.average(absolute_distance_optimal), "times longer than the optimal path")
-    
+
+    print("Grid path generation on dense maps took on average", np.average(absolute_time_grid_dense), "seconds")
+    print("Grid path generation found no path on", failures_grid_dense, "of", n, "dense maps")
+
+def benchmark_replanning(n = 100, edits = 10):
+
+    absolute_time_optimal = np.array([])
+    absolute_time_dynamic = np.array([])
+
+    seed(0)
+
+    for _ in tqdm(range(n)):
+        map = MapGenerator.generate(1000, 1000)
+        path_finder = DynamicMapPathFinder(map)
+        path_finder.generate_path()
+
+        for _ in range(edits):
+            # move a random obstacle a bit up or down
+            obstacle = map.obstacles[randint(0, len(map.obstacles) - 1)]
+            y = min(max(obstacle.y + randint(-50, 50), 0), map.height - obstacle.height)
+
+            # the graph update is part of the replanning cost
+            start = time.perf_counter()
+            map.move_obstacle(obstacle, obstacle.x, y)
+            path_finder.generate_path()
+            end = time.perf_counter()
+            absolute_time_dynamic = np.append(absolute_time_dynamic, end - start)
+
+            start = time.perf_counter()
+            MapPathFinder.generate_optimal_path(map)
+            end = time.perf_counter()
+            absolute_time_optimal = np.append(absolute_time_optimal, end - start)
+
+    print("Optimal path generation took on average", np.average(absolute_time_optimal), "seconds per edit")
+    print("Dynamic replanning took on average", np.average(absolute_time_dynamic), "seconds per edit")
+    print("Dynamic replanning is on average", np.average(absolute_time_optimal) / np.average(absolute_time_dynamic), "times faster than the optimal path generation")
+
 if __name__ == "__main__":
     map = MapGenerator.generate(500, 600)
     map.show()
@@ -590,4 +1481,7 @@ if __name__ == "__main__":
     map.show(path, "Optimal path")
 
     path = MapPathFinder.generate_approx_path(map)
-    map.show(path, "Approx path")
\ No newline at end of file
+    map.show(path, "Approx path")
+
+    path = MapPathFinder.generate_grid_path(map)
+    map.show(path, "Grid path")
\ No newline at end of file
@@ -0,0 +1,314 @@
+"""
+A small path finding service, so several processes can share loaded maps and
+their preprocessing instead of paying for it in every process.
+
+The service loads maps by id (a json file of MapFileHandler in the map
+directory, or a map added with add_map) and keeps them compiled in memory.
+Concurrent requests for the same map are collected for a short time and
+planned together as one batch, duplicate queries are only planned once and
+optimal paths reuse the search tree of a DynamicMapPathFinder, which searches
+from the goal.
+
+The protocol is one json object per line over TCP (localhost) or a Unix socket:
+
+    {"id": 1, "method": "path", "map": "map1", "start": [50, 500], "algorithm": "optimal"}
+    {"id": 2, "method": "metrics"}
+"""
+
+from collections import deque
+import asyncio
+import socket
+import json
+import time
+import os
+
+import numpy as np
+
+from map import *
+
+class PathService():
+
+    def __init__(self, map_directory=".", batch_window=0.005, max_batch_size=64, cache=None):
+        self.map_directory = map_directory
+        self.batch_window = batch_window # seconds to wait for more requests of the same map
+        self.max_batch_size = max_batch_size
+        self.cache = cache if cache is not None else PathCache()
+
+        self.maps = {} # map id -> compiled map
+        self.path_finders = {} # map id -> DynamicMapPathFinder
+        self.map_locks = {}
+
+        self.pending = {} # map id -> [(query, future)]
+        self.flush_handles = {}
+        self.tasks = set() # running batches, the event loop only keeps weak references
+
+        # metrics
+        self.latencies = deque(maxlen=10000)
+        self.requests = 0
+        self.batches = 0
+        self.batched_queries = 0
+        self.coalesced_queries = 0
+        self.max_queue_depth = 0
+
+    def add_map(self, map_id, map):
+        self.maps[map_id] = map.compile()
+
+    async def serve(self, host="127.0.0.1", port=8765, path=None):
+        if path is not None:
+            server = await asyncio.start_unix_server(self._handle_connection, path=path)
+        else:
+            server = await asyncio.start_server(self._handle_connection, host=host, port=port)
+        async with server:
+            await server.serve_forever()
+
+    async def generate_path(self, map_id, start=None, algorithm="optimal"):
+        # returns the path as a list of (x, y) or None if there is no path
+        if algorithm not in PathCache.algorithms:
+            raise ValueError("unknown algorithm {}".format(algorithm))
+        if start is not None:
+            start = self._check_start(start)
+            # maps that are not loaded yet are checked when the batch is planned
+            if map_id in self.maps:
+                self._check_start_in_map(self.maps[map_id], start)
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(map_id, []).append(((algorithm, start), future))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+        if len(self.pending[map_id]) >= self.max_batch_size:
+            self._flush(map_id)
+        elif map_id not in self.flush_handles:
+            self.flush_handles[map_id] = asyncio.get_running_loop().call_later(self.batch_window, self._flush, map_id)
+
+        return await future
+
+    @staticmethod
+    def _check_start(start):
+        # a shared path finder must never see a broken start, json accepts NaN and 1e999
+        if not isinstance(start, (list, tuple)) or len(start) != 2:
+            raise ValueError("start must be [x, y]")
+        if not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in start):
+            raise ValueError("start must be [x, y] with numbers")
+        if not all(np.isfinite(value) for value in start):
+            raise ValueError("start must be finite")
+        return (float(start[0]), float(start[1]))
+
+    @staticmethod
+    def _check_start_in_map(map, start):
+        x, y = start
+        if not (0 <= x <= map.width and 0 <= y <= map.height):
+            raise ValueError("start ({}, {}) is outside of the map".format(x, y))
+
+    @property
+    def queue_depth(self):
+        return sum(len(queries) for queries in self.pending.values())
+
+    def metrics(self):
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "average_batch_size": self.batched_queries / self.batches if self.batches > 0 else 0,
+            "coalesced_queries": self.coalesced_queries,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "latency_ms": {
+                "p50": float(np.percentile(latencies, 50)) if len(latencies) > 0 else 0,
+                "p90": float(np.percentile(latencies, 90)) if len(latencies) > 0 else 0,
+                "p99": float(np.percentile(latencies, 99)) if len(latencies) > 0 else 0,
+            },
+            "maps": len(self.maps),
+        }
+
+    def _flush(self, map_id):
+        handle = self.flush_handles.pop(map_id, None)
+        if handle is not None:
+            handle.cancel()
+        batch = self.pending.pop(map_id, [])
+        if len(batch) > 0:
+            task = asyncio.ensure_future(self._process_batch(map_id, batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _process_batch(self, map_id, batch):
+        loop = asyncio.get_running_loop()
+
+        # only one batch per map at a time, the path finders are not thread safe
+        lock = self.map_locks.setdefault(map_id, asyncio.Lock())
+        async with lock:
+            try:
+                if map_id not in self.maps:
+                    self.maps[map_id] = await loop.run_in_executor(None, self._load_map, map_id)
+            except Exception as error:
+                # do not keep a lock for every unknown map id
+                self.map_locks.pop(map_id, None)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                return
+
+            queries = list(dict.fromkeys(query for query, _ in batch))
+            results = await loop.run_in_executor(None, self._plan, map_id, queries)
+
+        self.batches += 1
+        self.batched_queries += len(batch)
+        self.coalesced_queries += len(batch) - len(queries)
+
+        # a failed query only fails its own requests, not the whole batch
+        for query, future in batch:
+            if future.done():
+                continue
+            if isinstance(results[query], Exception):
+                future.set_exception(results[query])
+            else:
+                future.set_result(results[query])
+
+    def _load_map(self, map_id):
+        filename = os.path.join(self.map_directory, os.path.basename(map_id) + ".json")
+        if not os.path.exists(filename):
+            raise ValueError("unknown map {}".format(map_id))
+        return MapFileHandler.load(filename).compile()
+
+    def _plan(self, map_id, queries):
+        # runs in a worker thread, returns the path or the exception of every query
+        map = self.maps[map_id]
+        results = {}
+        for algorithm, start in queries:
+            try:
+                results[(algorithm, start)] = self._plan_query(map_id, map, algorithm, start)
+            except Exception as error:
+                results[(algorithm, start)] = error
+        return results
+
+    def _plan_query(self, map_id, map, algorithm, start):
+        if start is not None:
+            self._check_start_in_map(map, start)
+        query_map = map if start is None else Map(map.width, map.height, Checkpoint(*start), map.goal, map.obstacles)
+
+        if algorithm == "optimal":
+            if map_id not in self.path_finders:
+                self.path_finders[map_id] = DynamicMapPathFinder(map)
+            path_finder = self.path_finders[map_id]
+            path = path_finder.generate_path_from(query_map.start.x, query_map.start.y)
+        else:
+            path = self.cache.generate_path(query_map, algorithm)
+
+        return None if path is None else [(float(checkpoint.x), float(checkpoint.y)) for checkpoint in path]
+
+    async def _handle_connection(self, reader, writer):
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # requests of one connection are handled concurrently, the
+                # responses are matched by their id
+                task = asyncio.ensure_future(self._handle_request(line, writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if len(tasks) > 0:
+                await asyncio.wait(tasks)
+        finally:
+            writer.close()
+
+    async def _handle_request(self, line, writer, write_lock):
+        received = time.perf_counter()
+        response = {}
+        try:
+            request = json.loads(line)
+            response["id"] = request.get("id")
+
+            if request["method"] == "path":
+                self.requests += 1
+                response["path"] = await self.generate_path(request["map"], request.get("start"), request.get("algorithm", "optimal"))
+                self.latencies.append(time.perf_counter() - received)
+            elif request["method"] == "metrics":
+                response["metrics"] = self.metrics()
+            else:
+                raise ValueError("unknown method {}".format(request["method"]))
+        except Exception as error:
+            response["error"] = str(error)
+
+        async with write_lock:
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+
+
+class PathClient():
+    # keeps one connection open and reuses it for all requests
+
+    def __init__(self, host="127.0.0.1", port=8765, path=None, timeout=60):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.timeout = timeout
+
+        self.socket = None
+        self.file = None
+        self.request_id = 0
+
+    def connect(self):
+        if self.path is not None:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.settimeout(self.timeout)
+            self.socket.connect(self.path)
+        else:
+            self.socket = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.file = self.socket.makefile("rwb")
+
+    def close(self):
+        if self.socket is not None:
+            self.file.close()
+            self.socket.close()
+            self.socket = None
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def generate_path(self, map_id, x=None, y=None, algorithm="optimal"):
+        # returns the path as a list of Checkpoints, like MapPathFinder
+        request = {"method": "path", "map": map_id, "algorithm": algorithm}
+        if x is not None and y is not None:
+            request["start"] = [x, y]
+
+        points = self._request(request)["path"]
+        if points is None:
+            return None
+        return [Checkpoint(x, y) for x, y in points]
+
+    def metrics(self):
+        return self._request({"method": "metrics"})["metrics"]
+
+    def _request(self, request):
+        if self.socket is None:
+            self.connect()
+
+        self.request_id += 1
+        request["id"] = self.request_id
+        try:
+            self.file.write((json.dumps(request) + "\n").encode())
+            self.file.flush()
+            line = self.file.readline()
+        except OSError:
+            # the connection is not usable anymore, reconnect on the next request
+            self.close()
+            raise
+        if not line:
+            self.close()
+            raise ConnectionError("connection closed by the service")
+
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+
+if __name__ == "__main__":
+    service = PathService("maps")
+    asyncio.run(service.serve())
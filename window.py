@@ -22,6 +22,11 @@ class BubbleWindow(tk.Tk):
         self.after(1, self.event_loop)
 
         self.step_function = step_function # function to be called every frame
+
+        # alternatively, a function that returns the latest snapshot (or None if
+        # there is no new one) and a function that draws it
+        self.snapshot_function = None
+        self.draw_snapshot_function = None
     
     @property
     def status_text(self):
@@ -45,6 +50,11 @@ class BubbleWindow(tk.Tk):
         if self.step_function is not None:
             self.canvas.delete("all")
             self.step_function()
+        if self.snapshot_function is not None:
+            snapshot = self.snapshot_function()
+            if snapshot is not None:
+                self.canvas.delete("all")
+                self.draw_snapshot_function(snapshot)
         self.after(1, self.event_loop)
 
     def start(self):